@@ -1,15 +1,31 @@
 #!/usr/bin/env python3
 
+import asyncio
+from contextlib import contextmanager
 from datetime import datetime as dt
+from http.client import HTTPException, HTTPSConnection, RemoteDisconnected
 import json
 import logging
+import queue
 import re
 import threading
 import time
 from os import environ
 from pathlib import Path
-from urllib.error import HTTPError
-from urllib.request import Request, urlopen
+from urllib.parse import urlsplit
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:  # non-Linux or package missing: fall back to polling
+    INotify = None
+
+try:
+    from orjson import dumps
+except ImportError:  # stdlib fallback, same bytes-returning interface
+
+    def dumps(obj):
+        return json.dumps(obj).encode("utf8")
+
 
 logging.basicConfig()
 log = logging.getLogger(__name__)
@@ -18,7 +34,7 @@ log.setLevel(level=environ.get("LOGLEVEL", "INFO"))
 BASE_URL = "https://api.mindset.io/apps"
 
 
-class LogStream:
+class Poster:
     REQ_ARGS = {
         "method": "POST",
         "headers": {
@@ -26,25 +42,135 @@ class LogStream:
             "User-Agent": "Syslog stream",
         },
     }
+    BATCH_SIZE = 64  # max records per POST
+    BATCH_WAIT = 0.05  # max seconds to wait for a batch to fill
 
-    def __init__(self, rec_type, logfile, regex, app_idn, api_key):
+    def __init__(self, app_idn, api_key):
         self.api_key = environ.get("LOGGING_API_KEY") or api_key
         self.app_idn = environ.get("LOGGING_APP_IDN") or app_idn
         self.api_url = f"{BASE_URL}/{self.app_idn}/run?api_key={self.api_key}"
+        url = urlsplit(self.api_url)
+        self._api_path = f"{url.path}?{url.query}"
+        # kept open across posts; only the poster thread uses it
+        self._conn = HTTPSConnection(url.netloc, timeout=10)
+        self._queue = queue.Queue(maxsize=10_000)
+        threading.Thread(target=self._poster, daemon=True).start()
+
+    def put(self, logrecord):
+        try:
+            self._queue.put_nowait(logrecord)
+        except queue.Full:
+            log.warning("post queue full, dropping log record: %s", logrecord)
+
+    def _poster(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.BATCH_WAIT
+            while len(batch) < self.BATCH_SIZE:
+                timeout = deadline - time.monotonic()
+                try:
+                    batch.append(self._queue.get(timeout=max(timeout, 0)))
+                except queue.Empty:
+                    break
+            try:
+                self._post(batch)
+            except Exception:  # keep the worker alive, or records pile up
+                log.exception("failed to post %d log record(s)", len(batch))
+
+    def _post(self, logrecords):
+        data = dumps({"args": {"logrecords": logrecords}})
+        while True:
+            reused = self._conn.sock is not None
+            try:
+                self._conn.request(
+                    self.REQ_ARGS["method"],
+                    self._api_path,
+                    body=data,
+                    headers=self.REQ_ARGS["headers"],
+                )
+                resp = self._conn.getresponse()
+                body = resp.read()  # drain so the connection can be reused
+                break
+            except (RemoteDisconnected, BrokenPipeError, ConnectionResetError) as e:
+                self._conn.close()
+                if reused:
+                    # idle keep-alive socket dropped by the server before any
+                    # response: resend once on a fresh connection
+                    continue
+                log.error("CONNECTION ERROR: %r", e)
+                return
+            except (HTTPException, OSError) as e:
+                # not retried: the POST may already have been processed
+                self._conn.close()
+                log.error("CONNECTION ERROR: %r", e)
+                return
+        if not 200 <= resp.status < 300:
+            log.error("HTTP ERROR: %s (%s)", resp.reason, resp.status)
+            log.error("%s", body.decode())
+
+
+class LogStream:
+    YIELD_EVERY = 100  # lines read before yielding to other streams
+
+    def __init__(self, rec_type, logfile, regex, poster):
         self.rec_type = rec_type
         self.logfile = Path(logfile)
         self.regex = [regex] if isinstance(regex, str) else regex
-        log.info(f"listening on {self.logfile}")
+        self._match_fn = self._matcher(self.regex)
+        self.poster = poster
+        log.info("listening on %s", self.logfile)
 
     @staticmethod
-    def tail(fh):
+    def _matcher(regex):
+        patterns = [re.compile(p) for p in regex]
+        if len(patterns) == 1:
+            return patterns[0].search
+        # fold into one alternation (a single scan per line) unless groups
+        # could clash or shift: reused names, numbered backreferences
+        if not any(p.groups for p in patterns):
+            try:
+                return re.compile("|".join(f"(?:{p})" for p in regex)).search
+            except re.error:  # e.g. inline global flags such as (?i)
+                pass
+        searches = [p.search for p in patterns]
+        return lambda record: any(search(record) for search in searches)
+
+    @contextmanager
+    def _watch(self):
+        if INotify is None:
+            yield None
+            return
+        loop = asyncio.get_running_loop()
+        written = asyncio.Event()
+        with INotify() as inotify:
+            inotify.add_watch(str(self.logfile), flags.MODIFY)
+
+            def on_inotify():
+                inotify.read(timeout=0)  # drain; events only signal new data
+                written.set()
+
+            loop.add_reader(inotify.fileno(), on_inotify)
+            try:
+                yield written
+            finally:
+                loop.remove_reader(inotify.fileno())
+
+    async def tail(self, fh, written):
         fh.seek(0, 2)
+        nlines = 0
         while True:
+            if written is not None:
+                written.clear()
             line = fh.readline()
             if line:
                 yield line
+                nlines += 1
+                if nlines % self.YIELD_EVERY == 0:
+                    await asyncio.sleep(0)  # let other streams run in a burst
+            elif written is not None:
+                await written.wait()
             else:
-                time.sleep(0.1)
+                await asyncio.sleep(0.1)
 
     def post_record(self, record):
         logrecord = {
@@ -52,39 +178,36 @@ class LogStream:
             "content": record,
             "timestamp": f"{dt.utcnow().isoformat()}Z",
         }
-        data = json.dumps({"args": {"logrecord": logrecord}})
-        log.info(f"posting log record ({self.rec_type}): {record}")
-        req = Request(self.api_url, **self.REQ_ARGS, data=data.encode("utf8"))
-        try:
-            _ = urlopen(req)
-        except HTTPError as e:
-            log.error(f"HTTP ERROR: {e.msg} ({e.code})")
-            log.error(f"{e.read().decode()}")
+        log.debug("posting log record (%s): %s", self.rec_type, record)
+        self.poster.put(logrecord)
 
-    def _matches(self, re_str):
-        while True:
-            record = (yield).strip()
-            if re.findall(re_str, record):
-                self.post_record(record)
+    async def stream(self):
+        with open(self.logfile) as fh, self._watch() as written:
+            async for line in self.tail(fh, written):
+                record = line.strip()
+                if self._match_fn(record):
+                    self.post_record(record)
 
-    def stream(self):
-        matches = [self._matches(smatch) for smatch in self.regex]
-        _ = [next(m) for m in matches]
-        while True:
-            fh = open(self.logfile)
-            for line in self.tail(fh):
-                for m in matches:
-                    m.send(line)
+
+async def main(config):
+    settings = config.pop("settings", {"api_key": None, "app_idn": None})
+    # one queue, worker and keep-alive connection shared by all log sources
+    poster = Poster(**settings)
+    streams = [
+        LogStream(stype, **params, poster=poster) for stype, params in config.items()
+    ]
+
+    async def run(ls):
+        # a failing stream (e.g. missing log file) must not stop the others
+        try:
+            await ls.stream()
+        except Exception:
+            log.exception("stream %s on %s stopped", ls.rec_type, ls.logfile)
+
+    await asyncio.gather(*(run(ls) for ls in streams))
 
 
 if __name__ == "__main__":
     with open(Path("config.json")) as f:
         config = json.load(f)
-    settings = config.pop("settings", {"api_key": None, "app_idn": None})
-    jobs = [
-        threading.Thread(
-            target=LogStream(stype, **params, **settings).stream, args=()
-        )
-        for stype, params in config.items()
-    ]
-    _ = [j.start() for j in jobs]
+    asyncio.run(main(config))
@@ -1,20 +1,67 @@
 #!/usr/bin/env python3
 
 from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime as dt
+from functools import lru_cache
 import json
 import logging
+import re
 
 import numpy as np
 import requests
-from scipy import stats as scipy_stats
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 RECORD_NT = namedtuple("record", "type content timestamp")
-logdate = (
-    lambda m, d, tm: f"{dt.strptime(f'{m} {d} {tm}', '%b %d %X'):%b-%d %H:%M:%S}"
-)
 logging.basicConfig(level="INFO")
+log = logging.getLogger(__name__)
+UFW_FIELD_RE = re.compile(r"([^\s=]+)(?:=(\S*))?")
+
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=32,
+        max_retries=Retry(total=2, backoff_factor=0.1),
+    ),
+)
+EXECUTOR = ThreadPoolExecutor(max_workers=4)
+
+
+def logdate(m, d, tm):
+    # syslog "%b %d %X" reformatted as "%b-%d %H:%M:%S" without a datetime
+    return f"{m}-{int(d):02d} {tm}"
+
+
+@lru_cache(maxsize=None)
+def page_html():
+    # page.html is the pre-rendered template.html: read on first use only,
+    # then kept for the life of the process
+    with open("page.html") as f:
+        return f.read()
+
+
+@lru_cache(maxsize=4096)
+def _fetch_ip_info(ipaddr):
+    # memoized per address: brute-force sources repeat the same IP heavily;
+    # failed lookups raise so that they are not cached
+    resp = SESSION.get(f"https://freegeoip.app/json/{ipaddr}", timeout=2)
+    if resp.status_code != 200:
+        raise requests.HTTPError(response=resp)
+    data = resp.json()
+    ip_dct = {
+        "country": data["country_code"],
+        "region": data["region_code"],
+        "city": data["city"],
+        "zipcode": data["zip_code"],
+        "timezone": data["time_zone"],
+        "lat": data["latitude"],
+        "lon": data["longitude"],
+    }
+    return {k: v or None for k, v in ip_dct.items()}
 
 
 class BaseRecord:
@@ -41,7 +88,7 @@ class BaseRecord:
     def fetch_ip_info_(ipaddr):
         if ipaddr is None:
             return
-        resp = requests.get(f"https://ipinfo.io/{ipaddr}")
+        resp = SESSION.get(f"https://ipinfo.io/{ipaddr}", timeout=2)
         if resp.status_code != 200:
             return
         data = resp.json()
@@ -60,20 +107,10 @@ class BaseRecord:
     def fetch_ip_info(ipaddr):
         if ipaddr is None:
             return
-        resp = requests.get(f"https://freegeoip.app/json/{ipaddr}")
-        if resp.status_code != 200:
+        try:
+            return _fetch_ip_info(ipaddr)
+        except requests.RequestException:  # incl. timeouts; raised, so never cached
             return
-        data = resp.json()
-        ip_dct = {
-            "country": data["country_code"],
-            "region": data["region_code"],
-            "city": data["city"],
-            "zipcode": data["zip_code"],
-            "timezone": data["time_zone"],
-            "lat": data["latitude"],
-            "lon": data["longitude"],
-        }
-        return {k: v or None for k, v in ip_dct.items()}
 
     def as_dict(self):
         return {
@@ -109,62 +146,124 @@ class UFW_BLOCK(BaseRecord):
     def parse(self):
         meta, data = self.content.split(" [UFW BLOCK] ")
         mo, day, daytime, host, *_ = meta.split(" ")
-        ddct = {}
-        for field in data.split(" "):
-            try:
-                k, v = field.split("=")
-            except ValueError:
-                k, v = field, None
-            ddct[k] = v
+        # valueless flags (SYN, DF, ...) map to None, empty values to ""
+        ddct = {m[1]: m[2] for m in UFW_FIELD_RE.finditer(data)}
         self.ipaddr = ddct["SRC"]
         self.data = {"logdate": logdate(mo, day, daytime), **ddct}
 
 
 def make_stats(data, trailing_hrs: int = 1):
     def calc_rate(tss):
-        idxs = tss > np.datetime64(dt.utcnow()) - np.timedelta64(
-            trailing_hrs, "h"
-        )
         rate_per_minute = None
-        if len(dts := np.diff(tss[idxs]) / np.timedelta64(1, "m")) > 1:
-            rate_per_minute = np.around(1 / scipy_stats.expon.fit(dts)[1], 2)
-        return {"rate_per_minute": rate_per_minute, "count": int(np.sum(idxs))}
+        if len(dts := np.diff(tss) / np.timedelta64(1, "m")) > 1:
+            # exponential MLE as in scipy's expon.fit: loc=min, scale=mean-loc;
+            # equal intervals give scale 0 (up to rounding): no rate then
+            if dts.max() != dts.min():
+                rate_per_minute = np.around(1 / (dts.mean() - dts.min()), 2)
+        return {"rate_per_minute": rate_per_minute, "count": len(tss)}
 
-    event_types = np.array(data["type"])
-    tss = np.array(data["timestamp"]).astype(np.datetime64)
+    # integer-coded event types: per-type masks compare ints, not strings
+    event_types, type_codes = np.unique(data["type"], return_inverse=True)
+    tss = np.array(data["timestamp"], dtype="datetime64[us]")
+    # cut the history down to the trailing window once, not once per type
+    idxs = tss > np.datetime64(dt.utcnow()) - np.timedelta64(trailing_hrs, "h")
+    tss, type_codes = tss[idxs], type_codes[idxs]
     stats = {"__ALL__": calc_rate(tss), "trailing_hrs": trailing_hrs}
-    for etype in np.unique(event_types):
-        stats[etype] = calc_rate(tss[event_types == etype])
+    for code, etype in enumerate(event_types):
+        stats[etype] = calc_rate(tss[type_codes == code])
     return stats
 
 
-def main(logrecord: dict, prev_data=None, trailing_hrs: int = 1):
+def load_record(logrecord: dict):
     raw_record = RECORD_NT(**logrecord)
-    obj = globals()[raw_record.type].from_record(raw_record)
-    data = prev_data or defaultdict(list)
+    return globals()[raw_record.type].from_record(raw_record)
+
+
+def prefetch_ip_info(objs, data):
+    # resolve a batch's not-yet-seen addresses concurrently; failures are
+    # kept as None so that ingest does not retry them one by one
+    zipit = zip(data.get("ipaddr", []), data.get("ipinfo", []))
+    seen = {ipaddr for ipaddr, ipinfo in zipit if ipinfo}
+    ipaddrs = {obj.ipaddr for obj in objs} - seen
+    futures = {ip: EXECUTOR.submit(BaseRecord.fetch_ip_info, ip) for ip in ipaddrs}
+    ipinfos = {}
+    for ipaddr, future in futures.items():
+        try:
+            ipinfos[ipaddr] = future.result()
+        except Exception:
+            log.exception("IP info lookup failed for %s", ipaddr)
+            ipinfos[ipaddr] = None
+    return ipinfos
+
+
+def ingest(obj, data, ipinfos=None):
     try:
         zipit = zip(data.get("ipaddr", []), data.get("ipinfo", []))
         zip_filter = filter(lambda z: (z[0] == obj.ipaddr and z[1]), zipit)
         obj.ipinfo = next(zip_filter)[1]
-        logging.info(f"prefetched {obj.ipaddr}")
+        log.debug("prefetched %s", obj.ipaddr)
     except StopIteration:
-        logging.info(f"fetching {obj.ipaddr}")
-        obj.ipinfo = obj.fetch_ip_info(obj.ipaddr)
+        log.debug("fetching %s", obj.ipaddr)
+        if ipinfos is not None and obj.ipaddr in ipinfos:
+            obj.ipinfo = ipinfos[obj.ipaddr]
+        else:
+            obj.ipinfo = obj.fetch_ip_info(obj.ipaddr)
 
-    for k in prev_data or {}:
+    for k in data:
         if hasattr(obj, k):
             data[k].append(getattr(obj, k))
+    return obj
+
+
+def ingest_batch(logrecords: list, data):
+    # a bad record only costs itself, not the rest of the batch
+    objs = []
+    for rec in logrecords:
+        try:
+            objs.append(load_record(rec))
+        except Exception:
+            log.exception("skipping unparsable log record: %s", rec)
+    ipinfos = prefetch_ip_info(objs, data) if len(objs) > 1 else None
+    ingested = []
+    for obj in objs:
+        try:
+            ingested.append(ingest(obj, data, ipinfos))
+        except Exception:
+            log.exception("skipping log record: %s", obj.content)
+    if not ingested:
+        raise ValueError("no log record in the batch could be ingested")
+    return ingested
+
+
+def main(
+    logrecord: dict = None,
+    prev_data=None,
+    trailing_hrs: int = 1,
+    logrecords: list = None,
+):
+    # a batch of `logrecords` shares one stats/page computation
+    if logrecords is not None and not logrecords:
+        raise ValueError("empty logrecords batch")
+    data = prev_data or defaultdict(list)
+    if logrecords is None:
+        objs = [ingest(load_record(logrecord), data)]
+    else:
+        objs = ingest_batch(logrecords, data)
     stats = make_stats(data=data, trailing_hrs=trailing_hrs)
-    with open("page.html") as f:
-        html = f.read()
-    return {**obj.as_dict(), "stats": stats, "html": html}
+    if logrecords is None:
+        return {**objs[0].as_dict(), "stats": stats, "html": page_html()}
+    return {
+        "records": [obj.as_dict() for obj in objs],
+        "stats": stats,
+        "html": page_html(),
+    }
 
 
 if __name__ == "__main__":  # Local testing
 
     def stream_data():
         with open("samples.jsonl") as f:
-            for line in f.readlines():
+            for line in f:
                 if line := line.strip():
                     yield json.loads(line)
 
@@ -176,4 +275,4 @@ if __name__ == "__main__":  # Local testing
         prev_data["stats"].append(entry["stats"])
         if en == 3:
             break
-    prn(prev_data["stats"])
+    log.info("stats: %s", prev_data["stats"])